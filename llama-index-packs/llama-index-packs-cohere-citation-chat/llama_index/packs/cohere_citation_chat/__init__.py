@@ -1,3 +1,56 @@
-from llama_index.packs.cohere_citation_chat.base import CohereCitationChatEnginePack
+import importlib
+from typing import TYPE_CHECKING, Any, List
 
-__all__ = ["CohereCitationChatEnginePack"]
+if TYPE_CHECKING:
+    from llama_index.packs.cohere_citation_chat.base import (
+        CohereCitationChatEnginePack,
+    )
+    from llama_index.packs.cohere_citation_chat.citations_context_chat_engine import (
+        CitationsContextChatEngine,
+        VectorStoreIndexWithCitationsChat,
+    )
+    from llama_index.packs.cohere_citation_chat.kv_cache import CohereDocKVCache
+    from llama_index.packs.cohere_citation_chat.memory import CachedMemory
+    from llama_index.packs.cohere_citation_chat.semantic_cache import (
+        SemanticContextCache,
+    )
+    from llama_index.packs.cohere_citation_chat.staged_retriever import (
+        StagedRetriever,
+    )
+
+# NOTE: exports are imported lazily (PEP 562), so importing the package does
+# not load llama_index.core and the Cohere integrations until they are used
+_LAZY_IMPORTS = {
+    "CachedMemory": "llama_index.packs.cohere_citation_chat.memory",
+    "CitationsContextChatEngine": (
+        "llama_index.packs.cohere_citation_chat.citations_context_chat_engine"
+    ),
+    "CohereCitationChatEnginePack": "llama_index.packs.cohere_citation_chat.base",
+    "CohereDocKVCache": "llama_index.packs.cohere_citation_chat.kv_cache",
+    "SemanticContextCache": "llama_index.packs.cohere_citation_chat.semantic_cache",
+    "StagedRetriever": "llama_index.packs.cohere_citation_chat.staged_retriever",
+    "VectorStoreIndexWithCitationsChat": (
+        "llama_index.packs.cohere_citation_chat.citations_context_chat_engine"
+    ),
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name in _LAZY_IMPORTS:
+        return getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> List[str]:
+    return list(__all__)
+
+
+__all__ = [
+    "CachedMemory",
+    "CitationsContextChatEngine",
+    "CohereCitationChatEnginePack",
+    "CohereDocKVCache",
+    "SemanticContextCache",
+    "StagedRetriever",
+    "VectorStoreIndexWithCitationsChat",
+]
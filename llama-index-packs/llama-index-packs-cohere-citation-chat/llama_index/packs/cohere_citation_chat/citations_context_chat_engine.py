@@ -1,33 +1,54 @@
 import asyncio
-from threading import Thread
-from typing import List, Optional, Any
+import os
+import string
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, Thread
+from weakref import WeakValueDictionary
+from typing import Callable, Coroutine, Dict, List, Optional, Any, Set, Tuple
 from enum import Enum
 from dataclasses import dataclass, field
 import logging
 
-from llama_index.core.callbacks import trace_method
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse, MessageRole
+from llama_index.core.callbacks import CallbackManager, trace_method
 from llama_index.core.chat_engine.context import ContextChatEngine
-from llama_index.core.base.llms.types import ChatMessage
-from llama_index.core.tools import ToolOutput
 from llama_index.core.chat_engine.types import (
     AgentChatResponse,
+    BaseChatEngine,
     StreamingAgentChatResponse,
     is_function,
 )
+from llama_index.core.indices.vector_store.base import VectorStoreIndex
+from llama_index.core.llms.llm import LLM
 from llama_index.core.llms.utils import LLMType, resolve_llm
-from llama_index.core.chat_engine.types import BaseChatEngine
-from llama_index.core import VectorStoreIndex
-from llama_index.core.settings import Settings
-from llama_index.core.memory import BaseMemory
+from llama_index.core.memory import BaseMemory, ChatMemoryBuffer
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle, QueryType
+from llama_index.core.service_context import ServiceContext
+from llama_index.core.settings import (
+    Settings,
+    callback_manager_from_settings_or_context,
+    llm_from_settings_or_context,
+)
+from llama_index.core.tools import ToolOutput
 
+from .kv_cache import CohereDocKVCache
+from .memory import CachedMemory
+from .semantic_cache import CachedContext, SemanticContextCache
+from .staged_retriever import StagedRetriever
 from .types import (
     Document,
     Citation,
     CitationsSettings,
+    StreamBatchSettings,
 )
 
 from .utils import (
-    convert_nodes_to_documents_list,
+    convert_nodes_to_documents_list_cached,
+    get_cached_documents_list,
     convert_chat_response_to_citations,
     convert_chat_response_to_documents,
 )
@@ -35,6 +56,149 @@ from .utils import (
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING)
 
+DEFAULT_STREAM_POOL_SIZE = 32
+
+
+def _get_stream_pool_size() -> int:
+    """Get the stream pool size from `LLAMA_CHAT_POOL`, falling back to the default."""
+    value = os.environ.get("LLAMA_CHAT_POOL")
+    if value is None:
+        return DEFAULT_STREAM_POOL_SIZE
+    try:
+        pool_size = int(value)
+    except ValueError:
+        pool_size = 0
+    if pool_size < 1:
+        logger.warning(
+            f"Invalid LLAMA_CHAT_POOL value {value!r}, "
+            f"using {DEFAULT_STREAM_POOL_SIZE} workers."
+        )
+        return DEFAULT_STREAM_POOL_SIZE
+    return pool_size
+
+
+# Shared pool draining streamed responses into chat history, so concurrent
+# streams reuse a bounded set of threads instead of starting one per request.
+# A slot is held for each running writer; when all are taken, the writer gets
+# its own thread rather than waiting in the pool queue behind whole streams.
+_STREAM_POOL_SIZE = _get_stream_pool_size()
+_STREAM_POOL = ThreadPoolExecutor(
+    max_workers=_STREAM_POOL_SIZE,
+    thread_name_prefix="citations_chat_stream",
+)
+_stream_pool_slots = BoundedSemaphore(_STREAM_POOL_SIZE)
+
+
+def _start_stream_writer(write_response: Callable[..., None], *args: Any) -> None:
+    """Run a stream writer on the shared pool, or on a new thread if it is full."""
+    slots = _stream_pool_slots
+    if not slots.acquire(blocking=False):
+        Thread(target=write_response, args=args).start()
+        return
+
+    def run() -> None:
+        try:
+            write_response(*args)
+        finally:
+            slots.release()
+
+    _STREAM_POOL.submit(run)
+
+
+# Strong references to pending history writers; the event loop only keeps weak
+# references to tasks, so an unreferenced task may be garbage collected.
+_background_tasks: Set["asyncio.Task[None]"] = set()
+
+
+# short user messages ("yes", "thanks", ...) recur across chat histories, so
+# they are interned to share one string object; longer ones are left alone
+_MAX_INTERNED_MESSAGE_LENGTH = 64
+
+
+def _to_user_message(message: str) -> ChatMessage:
+    """Build the chat history entry for a user message."""
+    # sys.intern only accepts exact str instances, not subclasses
+    if type(message) is str and len(message) <= _MAX_INTERNED_MESSAGE_LENGTH:
+        message = sys.intern(message)
+    return ChatMessage(content=message, role=MessageRole.USER)
+
+
+def _split_context_template(context_template: str) -> Optional[Tuple[str, str]]:
+    """Split a context template around its only `{context_str}` field.
+
+    Returns None for templates that need `str.format`, e.g. with other fields
+    or a format spec.
+    """
+    prefix, suffix = "", ""
+    seen_field = False
+    for literal_text, field_name, format_spec, conversion in string.Formatter().parse(
+        context_template
+    ):
+        if seen_field:
+            suffix += literal_text
+        else:
+            prefix += literal_text
+        if field_name is None:
+            continue
+        if seen_field or field_name != "context_str" or format_spec or conversion:
+            return None
+        seen_field = True
+    return (prefix, suffix) if seen_field else None
+
+
+def _schedule_history_write(coro: Coroutine[Any, Any, None]) -> None:
+    """Run a history writer as a task on the running event loop."""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _adiscard_task(task: "asyncio.Task[Any]") -> None:
+    """Cancel a task whose result is not needed, and wait for it to finish."""
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        # the task failed before it was cancelled; its result was not needed
+        logger.debug(f"Discarded task failed: {e}")
+
+
+class _TokenBatcher:
+    """Groups streamed deltas into batches of growing size."""
+
+    def __init__(self, settings: StreamBatchSettings) -> None:
+        self._settings = settings
+        self._batch: List[str] = []
+        self._batch_size = settings.initial_batch_size
+        self._last_flush = time.monotonic()
+
+    def add(self, delta: Optional[str]) -> Optional[str]:
+        """Add a delta, returning the joined batch once it is due."""
+        batch = self._batch
+        if delta:
+            batch.append(delta)
+        if batch and (
+            len(batch) >= self._batch_size
+            or time.monotonic() - self._last_flush >= self._settings.flush_interval
+        ):
+            self._batch_size = min(
+                self._batch_size * self._settings.growth_factor,
+                self._settings.max_batch_size,
+            )
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        """Return the pending deltas joined together, if any."""
+        self._last_flush = time.monotonic()
+        if not self._batch:
+            return None
+        batch = "".join(self._batch)
+        self._batch = []
+        return batch
+
 
 @dataclass
 class AgentCitationsChatResponse(AgentChatResponse):
@@ -59,6 +223,25 @@ class StreamingAgentCitationsChatResponse(StreamingAgentChatResponse):
             citations_stream_event_type="citation-generation",
         )
     )
+    stream_batch_settings: StreamBatchSettings = field(
+        default_factory=StreamBatchSettings
+    )
+
+    def _process_chat_chunk(self, chat: ChatResponse) -> None:
+        """Collect the citations and documents carried by a stream event."""
+        if chat.raw is None:
+            return
+        event_type = chat.raw.get("event_type", "")
+        # Citations stream event
+        if event_type == self.citations_settings.citations_stream_event_type:
+            self.citations += convert_chat_response_to_citations(
+                chat, self.citations_settings
+            )
+        # Documents stream event
+        if event_type == self.citations_settings.documents_stream_event_type:
+            self.documents += convert_chat_response_to_documents(
+                chat, self.citations_settings
+            )
 
     def write_response_to_history(
         self, memory: BaseMemory, raise_error: bool = False
@@ -67,31 +250,22 @@ class StreamingAgentCitationsChatResponse(StreamingAgentChatResponse):
             raise ValueError(
                 "chat_stream is None. Cannot write to history without chat_stream."
             )
+        batcher = _TokenBatcher(self.stream_batch_settings)
+        # bind the per-token calls once, outside of the stream loop
+        add_to_batch = batcher.add
+        put_in_queue = self.put_in_queue
+        process_chat_chunk = self._process_chat_chunk
         # try/except to prevent hanging on error
         try:
             final_text = ""
             for chat in self.chat_stream:
-                # LLM response queue
+                # LLM response queue, fed in growing batches of tokens
                 self._is_function = is_function(chat.message)
-                self.put_in_queue(chat.delta)
                 final_text += chat.delta or ""
-                if chat.raw is not None:
-                    # Citations stream event
-                    if (
-                        chat.raw.get("event_type", "")
-                        == self.citations_settings.citations_stream_event_type
-                    ):
-                        self.citations += convert_chat_response_to_citations(
-                            chat, self.citations_settings
-                        )
-                    # Documents stream event
-                    if (
-                        chat.raw.get("event_type", "")
-                        == self.citations_settings.documents_stream_event_type
-                    ):
-                        self.documents += convert_chat_response_to_documents(
-                            chat, self.citations_settings
-                        )
+                batch = add_to_batch(chat.delta)
+                if batch:
+                    put_in_queue(batch)
+                process_chat_chunk(chat)
             if self._is_function is not None:  # if loop has gone through iteration
                 # NOTE: this is to handle the special case where we consume some of the
                 # chat stream, but not all of it (e.g. in react agent)
@@ -104,6 +278,10 @@ class StreamingAgentCitationsChatResponse(StreamingAgentChatResponse):
                 )
             else:
                 raise
+        finally:
+            batch = batcher.flush()
+            if batch:
+                put_in_queue(batch)
 
         self._is_done = True
 
@@ -114,38 +292,31 @@ class StreamingAgentCitationsChatResponse(StreamingAgentChatResponse):
         self,
         memory: BaseMemory,
     ) -> None:
+        self._ensure_async_setup()
+
         if self.achat_stream is None:
             raise ValueError(
                 "achat_stream is None. Cannot asynchronously write to "
                 "history without achat_stream."
             )
+        batcher = _TokenBatcher(self.stream_batch_settings)
+        # bind the per-token calls once, outside of the stream loop
+        add_to_batch = batcher.add
+        aput_in_queue = self.aput_in_queue
+        process_chat_chunk = self._process_chat_chunk
         # try/except to prevent hanging on error
         try:
             final_text = ""
             async for chat in self.achat_stream:
-                # Chat response queue
+                # Chat response queue, fed in growing batches of tokens
                 self._is_function = is_function(chat.message)
-                self.aput_in_queue(chat.delta)
                 final_text += chat.delta or ""
+                batch = add_to_batch(chat.delta)
+                if batch:
+                    aput_in_queue(batch)
                 if self._is_function is False:
                     self._is_function_false_event.set()
-                if chat.raw is not None:
-                    # Citations stream event
-                    if (
-                        chat.raw.get("event_type", "")
-                        == self.citations_settings.citations_stream_event_type
-                    ):
-                        self.citations += convert_chat_response_to_citations(
-                            chat, self.citations_settings
-                        )
-                    # Documents stream event
-                    if (
-                        chat.raw.get("event_type", "")
-                        == self.citations_settings.documents_stream_event_type
-                    ):
-                        self.documents += convert_chat_response_to_documents(
-                            chat, self.citations_settings
-                        )
+                process_chat_chunk(chat)
                 self._new_item_event.set()
             if self._is_function is not None:  # if loop has gone through iteration
                 # NOTE: this is to handle the special case where we consume some of the
@@ -154,6 +325,9 @@ class StreamingAgentCitationsChatResponse(StreamingAgentChatResponse):
                 memory.put(chat.message)
         except Exception as e:
             logger.warning(f"Encountered exception writing response to history: {e}")
+        batch = batcher.flush()
+        if batch:
+            aput_in_queue(batch)
         self._is_done = True
 
 
@@ -272,6 +446,14 @@ class VectorStoreIndexWithCitationsChat(VectorStoreIndex):
             )
 
 
+# engines returned by CitationsContextChatEngine.from_shared; an engine holds
+# its retriever and LLM, so their ids stay valid for as long as it is alive
+_shared_engines: "WeakValueDictionary[Tuple[Any, int, int], Any]" = (
+    WeakValueDictionary()
+)
+_shared_engines_lock = Lock()
+
+
 class CitationsContextChatEngine(ContextChatEngine):
     """Cohere Context + Citations Chat Engine.
 
@@ -282,30 +464,437 @@ class CitationsContextChatEngine(ContextChatEngine):
     NOTE: this is made to be compatible with Cohere's chat model Document mode
     """
 
-    @trace_method("chat")
-    def chat(
-        self, message: str, chat_history: Optional[List[ChatMessage]] = None
-    ) -> AgentCitationsChatResponse:
-        if chat_history is not None:
-            self._memory.set(chat_history)
-        self._memory.put(ChatMessage(content=message, role="user"))
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        llm: LLM,
+        memory: BaseMemory,
+        prefix_messages: List[ChatMessage],
+        node_postprocessors: Optional[List[BaseNodePostprocessor]] = None,
+        context_template: Optional[str] = None,
+        callback_manager: Optional[CallbackManager] = None,
+        context_cache: Optional[SemanticContextCache] = None,
+        kv_cache: Optional[CohereDocKVCache] = None,
+        stream_batch_settings: Optional[StreamBatchSettings] = None,
+        cache_chat_history: bool = False,
+        speculative: bool = False,
+    ) -> None:
+        if speculative and context_cache is not None:
+            raise ValueError("Cannot specify both speculative and context_cache")
+        if cache_chat_history and not isinstance(memory, CachedMemory):
+            memory = CachedMemory(memory=memory)
+        super().__init__(
+            retriever,
+            llm=llm,
+            memory=memory,
+            prefix_messages=prefix_messages,
+            node_postprocessors=node_postprocessors,
+            context_template=context_template,
+            callback_manager=callback_manager,
+        )
+        self._context_cache = context_cache
+        self._kv_cache = kv_cache
+        self._stream_batch_settings = stream_batch_settings or StreamBatchSettings()
+        self._speculative = speculative
+        # last rendered context and its prefix messages
+        self._prefix_cache: Tuple[Optional[str], List[ChatMessage]] = (None, [])
 
-        context_str_template, nodes = self._generate_context(message)
-        prefix_messages = self._get_prefix_messages_with_context(context_str_template)
+        # the context template and prefix messages are fixed for the engine, so
+        # split them once here rather than on every turn
+        self._context_template_parts = _split_context_template(self._context_template)
+        self._system_prompt = ""
+        self._extra_prefix_messages = self._prefix_messages
+        if (
+            len(self._prefix_messages) != 0
+            and self._prefix_messages[0].role == MessageRole.SYSTEM
+        ):
+            self._system_prompt = str(self._prefix_messages[0].content).strip()
+            self._extra_prefix_messages = self._prefix_messages[1:]
+        self._system_role = self._llm.metadata.system_role
 
-        all_messages = self._memory.get_all()
-        # transform nodes to documents list
-        documents_list = convert_nodes_to_documents_list(nodes)
-        # prepare request kwargs
-        citations_settings = CitationsSettings()
-        kwargs = {}
+    @classmethod
+    def from_defaults(
+        cls,
+        retriever: BaseRetriever,
+        service_context: Optional[ServiceContext] = None,
+        chat_history: Optional[List[ChatMessage]] = None,
+        memory: Optional[BaseMemory] = None,
+        system_prompt: Optional[str] = None,
+        prefix_messages: Optional[List[ChatMessage]] = None,
+        node_postprocessors: Optional[List[BaseNodePostprocessor]] = None,
+        context_template: Optional[str] = None,
+        llm: Optional[LLM] = None,
+        context_cache: Optional[SemanticContextCache] = None,
+        kv_cache: Optional[CohereDocKVCache] = None,
+        stream_batch_settings: Optional[StreamBatchSettings] = None,
+        cache_chat_history: bool = False,
+        speculative: bool = False,
+        **kwargs: Any,
+    ) -> "CitationsContextChatEngine":
+        """Initialize a CitationsContextChatEngine from default parameters."""
+        llm = llm or llm_from_settings_or_context(Settings, service_context)
+
+        chat_history = chat_history or []
+        memory = memory or ChatMemoryBuffer.from_defaults(
+            chat_history=chat_history, token_limit=llm.metadata.context_window - 256
+        )
+
+        if system_prompt is not None:
+            if prefix_messages is not None:
+                raise ValueError(
+                    "Cannot specify both system_prompt and prefix_messages"
+                )
+            prefix_messages = [
+                ChatMessage(content=system_prompt, role=llm.metadata.system_role)
+            ]
+
+        prefix_messages = prefix_messages or []
+        node_postprocessors = node_postprocessors or []
+
+        return cls(
+            retriever,
+            llm=llm,
+            memory=memory,
+            prefix_messages=prefix_messages,
+            node_postprocessors=node_postprocessors,
+            callback_manager=callback_manager_from_settings_or_context(
+                Settings, service_context
+            ),
+            context_template=context_template,
+            context_cache=context_cache,
+            kv_cache=kv_cache,
+            stream_batch_settings=stream_batch_settings,
+            cache_chat_history=cache_chat_history,
+            speculative=speculative,
+        )
+
+    @classmethod
+    def from_shared(
+        cls, retriever: BaseRetriever, llm: LLM, **kwargs: Any
+    ) -> "CitationsContextChatEngine":
+        """Get the engine shared by all callers with the same retriever and LLM.
+
+        The engine is created with `from_defaults(retriever, llm=llm, **kwargs)`
+        on first use; later calls must not pass `kwargs`, since they could not
+        be applied to the existing engine. Keep per-session chat history out of
+        the shared engine by passing each session's memory to `chat_with`,
+        `stream_chat_with`, `achat_with` or `astream_chat_with`.
+        """
+        key = (cls, id(retriever), id(llm))
+        with _shared_engines_lock:
+            engine = _shared_engines.get(key)
+            if engine is None:
+                engine = cls.from_defaults(retriever, llm=llm, **kwargs)
+                _shared_engines[key] = engine
+            elif kwargs:
+                raise ValueError(
+                    "A shared engine already exists for this retriever and LLM; "
+                    f"cannot apply {', '.join(sorted(kwargs))}."
+                )
+        return engine
+
+    def _memory_for(self, memory: Optional[BaseMemory]) -> BaseMemory:
+        """Get the memory for a `*_with` call: the given one, or the engine's own.
+
+        The plain chat methods always use the engine's own memory and read it
+        directly.
+        """
+        return memory if memory is not None else self._memory
+
+    def _postprocess_nodes(
+        self, nodes: List[NodeWithScore], query_bundle: QueryBundle
+    ) -> List[NodeWithScore]:
+        """Apply the node postprocessors to retrieved nodes."""
+        for postprocessor in self._node_postprocessors:
+            nodes = postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+        return nodes
+
+    def _get_context_str(self, nodes: List[NodeWithScore]) -> str:
+        """Render the context template for the given nodes."""
+        context_str = "\n\n".join(
+            [n.node.get_content(metadata_mode=MetadataMode.LLM).strip() for n in nodes]
+        )
+        if self._context_template_parts is None:
+            return self._context_template.format(context_str=context_str)
+        prefix, suffix = self._context_template_parts
+        return prefix + context_str + suffix
+
+    def _generate_context(self, message: QueryType) -> Tuple[str, List[NodeWithScore]]:
+        """Generate context information from a message."""
+        query_bundle = (
+            message if isinstance(message, QueryBundle) else QueryBundle(message)
+        )
+        nodes = self._retriever.retrieve(query_bundle)
+        nodes = self._postprocess_nodes(nodes, query_bundle)
+        return self._get_context_str(nodes), nodes
+
+    async def _agenerate_context(
+        self, message: QueryType
+    ) -> Tuple[str, List[NodeWithScore]]:
+        """Generate context information from a message."""
+        query_bundle = (
+            message if isinstance(message, QueryBundle) else QueryBundle(message)
+        )
+        nodes = await self._retriever.aretrieve(query_bundle)
+        nodes = self._postprocess_nodes(nodes, query_bundle)
+        return self._get_context_str(nodes), nodes
+
+    def _get_prefix_messages_with_context(self, context_str: str) -> List[ChatMessage]:
+        """Get the prefix messages with context, reusing them if it is unchanged."""
+        cached_context_str, cached_prefix_messages = self._prefix_cache
+        if context_str == cached_context_str:
+            return cached_prefix_messages
+        context_str_w_sys_prompt = self._system_prompt + "\n" + context_str
+        prefix_messages = [
+            ChatMessage(content=context_str_w_sys_prompt, role=self._system_role),
+            *self._extra_prefix_messages,
+        ]
+        self._prefix_cache = (context_str, prefix_messages)
+        return prefix_messages
+
+    def _get_context_cache_keys(
+        self, cache: SemanticContextCache, message: str, memory: BaseMemory
+    ) -> Tuple[str, str]:
+        """Get the exact-match and history keys, ignoring the just-added message."""
+        history: List[ChatMessage] = []
+        if cache.history_window > 0:
+            history = memory.get_all()[:-1]
+        history_key = cache.get_history_key(history)
+        return cache.get_key(message, history_key), history_key
+
+    def _cache_context(
+        self,
+        cache: SemanticContextCache,
+        key: str,
+        history_key: str,
+        query_bundle: QueryBundle,
+        context_str_template: str,
+        nodes: List[NodeWithScore],
+        documents_list: List[Dict[str, Any]],
+    ) -> CachedContext:
+        """Store a retrieval result in the context cache."""
+        entry = CachedContext(
+            context_str=context_str_template,
+            nodes=nodes,
+            documents_list=documents_list,
+            embedding=query_bundle.embedding,
+            history_key=history_key,
+        )
+        cache.put(key, entry)
+        return entry
+
+    def _cache_similar_context(
+        self,
+        cache: SemanticContextCache,
+        key: str,
+        history_key: str,
+        similar: CachedContext,
+    ) -> None:
+        """Store a similarity hit under the exact key of the new message."""
+        # only the original query stays indexed for similarity lookups
+        cache.put(
+            key,
+            CachedContext(
+                similar.context_str,
+                similar.nodes,
+                similar.documents_list,
+                history_key=history_key,
+            ),
+        )
+
+    def _start_documents_list_conversion(
+        self, nodes: List[NodeWithScore]
+    ) -> "asyncio.Future[List[Dict[str, Any]]]":
+        """Start converting nodes to a documents list off the event loop thread.
+
+        Cache hits are served directly; conversions run on the loop's default
+        executor so large contexts do not block other coroutines.
+        """
+        loop = asyncio.get_running_loop()
+        documents_list = get_cached_documents_list(nodes)
+        if documents_list is not None:
+            future: "asyncio.Future[List[Dict[str, Any]]]" = loop.create_future()
+            future.set_result(documents_list)
+            return future
+        return loop.run_in_executor(None, convert_nodes_to_documents_list_cached, nodes)
+
+    async def _aconvert_nodes_to_documents_list(
+        self, nodes: List[NodeWithScore]
+    ) -> List[Dict[str, Any]]:
+        """Convert nodes to a documents list off the event loop thread."""
+        return await self._start_documents_list_conversion(nodes)
+
+    async def _agenerate_context_and_documents_list(
+        self, query_bundle: QueryBundle
+    ) -> Tuple[str, List[NodeWithScore], List[Dict[str, Any]]]:
+        """Generate context information and the documents list for a query.
+
+        The documents list is converted on the executor while the context
+        string is rendered on the event loop thread.
+        """
+        nodes = await self._retriever.aretrieve(query_bundle)
+        nodes = self._postprocess_nodes(nodes, query_bundle)
+        documents_list_future = self._start_documents_list_conversion(nodes)
+        try:
+            context_str = self._get_context_str(nodes)
+        except BaseException:
+            documents_list_future.cancel()
+            raise
+        return context_str, nodes, await documents_list_future
+
+    def _retrieve_context(
+        self, message: str, memory: BaseMemory
+    ) -> Tuple[str, List[NodeWithScore], List[Dict[str, Any]]]:
+        """Retrieve the context string, nodes and documents list for a message.
+
+        Uses the context cache, when configured, to skip the retriever (and,
+        on exact repeats, the query embedding) for repeated messages.
+        """
+        cache = self._context_cache
+        if cache is None:
+            context_str_template, nodes = self._generate_context(message)
+            return (
+                context_str_template,
+                nodes,
+                convert_nodes_to_documents_list_cached(nodes),
+            )
+
+        key, history_key = self._get_context_cache_keys(cache, message, memory)
+        cached = cache.get(key)
+        if cached is None:
+            query_bundle = QueryBundle(message)
+            if cache.embed_model is not None:
+                embedding = cache.embed_model.get_query_embedding(message)
+                query_bundle.embedding = embedding
+                cached = cache.get_similar(embedding, history_key)
+            if cached is None:
+                context_str_template, nodes = self._generate_context(query_bundle)
+                cached = self._cache_context(
+                    cache,
+                    key,
+                    history_key,
+                    query_bundle,
+                    context_str_template,
+                    nodes,
+                    convert_nodes_to_documents_list_cached(nodes),
+                )
+            else:
+                self._cache_similar_context(cache, key, history_key, cached)
+        return cached.context_str, list(cached.nodes), cached.documents_list
+
+    async def _aretrieve_context(
+        self, message: str, memory: BaseMemory
+    ) -> Tuple[str, List[NodeWithScore], List[Dict[str, Any]]]:
+        """Retrieve the context string, nodes and documents list for a message.
+
+        Uses the context cache, when configured, to skip the retriever (and,
+        on exact repeats, the query embedding) for repeated messages.
+        """
+        cache = self._context_cache
+        if cache is None:
+            return await self._agenerate_context_and_documents_list(
+                QueryBundle(message)
+            )
+
+        key, history_key = self._get_context_cache_keys(cache, message, memory)
+        cached = cache.get(key)
+        if cached is None:
+            query_bundle = QueryBundle(message)
+            if cache.embed_model is not None:
+                embedding = await cache.embed_model.aget_query_embedding(message)
+                query_bundle.embedding = embedding
+                cached = cache.get_similar(embedding, history_key)
+            if cached is None:
+                (
+                    context_str_template,
+                    nodes,
+                    documents_list,
+                ) = await self._agenerate_context_and_documents_list(query_bundle)
+                cached = self._cache_context(
+                    cache,
+                    key,
+                    history_key,
+                    query_bundle,
+                    context_str_template,
+                    nodes,
+                    documents_list,
+                )
+            else:
+                self._cache_similar_context(cache, key, history_key, cached)
+        return cached.context_str, list(cached.nodes), cached.documents_list
+
+    def _get_doc_kv_cache_kwargs(
+        self, nodes: List[NodeWithScore], record_kv_access: bool = True
+    ) -> Dict[str, Any]:
+        """Get the LLM kwargs carrying document fingerprints and cached KV blocks."""
+        if self._kv_cache is None or not self._uses_doc_kv_cache():
+            return {}
+        doc_fingerprints = tuple(n.node.node_id for n in nodes)
+        return {
+            "extra_body": {
+                "doc_fingerprints": doc_fingerprints,
+                "doc_kv_blocks": self._kv_cache.get_many(
+                    doc_fingerprints, record_access=record_kv_access
+                ),
+            }
+        }
+
+    def _uses_doc_kv_cache(self) -> bool:
+        """Whether requests carry cached KV blocks for the documents."""
+        return self._kv_cache is not None and getattr(
+            self._llm, "supports_doc_kv_cache", False
+        )
+
+    def _update_doc_kv_cache(
+        self, chat_response: ChatResponse, nodes: List[NodeWithScore]
+    ) -> None:
+        """Store the KV blocks returned by the LLM for the retrieved documents."""
+        if self._kv_cache is None or not chat_response.raw:
+            return
+        doc_kv_blocks = chat_response.raw.get("doc_kv_blocks") or {}
+        for n in nodes:
+            if n.node.node_id in doc_kv_blocks:
+                self._kv_cache.put(
+                    n.node.node_id,
+                    doc_kv_blocks[n.node.node_id],
+                    cost=len(n.node.get_content()),
+                )
+
+    def _get_retriever_tool_output(
+        self, message: str, prefix_messages: List[ChatMessage]
+    ) -> ToolOutput:
+        """Get the retriever tool output reported as the response source."""
+        prefix_message = prefix_messages[0]
+        return ToolOutput(
+            tool_name="retriever",
+            content=str(prefix_message),
+            raw_input={"message": message},
+            raw_output=prefix_message,
+        )
+
+    def _get_llm_kwargs(
+        self,
+        citations_settings: CitationsSettings,
+        nodes: List[NodeWithScore],
+        documents_list: List[Dict[str, Any]],
+        record_kv_access: bool = True,
+    ) -> Dict[str, Any]:
+        """Get the LLM request kwargs carrying the retrieved documents."""
+        kwargs: Dict[str, Any] = {}
         if citations_settings and citations_settings.documents_request_param:
             kwargs[citations_settings.documents_request_param] = documents_list
-        # and then uses an LLM to generate a response
-        chat_response = self._llm.chat(all_messages, **kwargs)
-        ai_message = chat_response.message
-        self._memory.put(ai_message)
+        kwargs.update(self._get_doc_kv_cache_kwargs(nodes, record_kv_access))
+        return kwargs
 
+    def _build_response(
+        self,
+        chat_response: ChatResponse,
+        message: str,
+        prefix_messages: List[ChatMessage],
+        nodes: List[NodeWithScore],
+        citations_settings: CitationsSettings,
+    ) -> AgentCitationsChatResponse:
+        """Build the chat response, with citations and documents, from the LLM response."""
         return AgentCitationsChatResponse(
             response=str(chat_response.message.content),
             citations=convert_chat_response_to_citations(
@@ -314,135 +903,284 @@ class CitationsContextChatEngine(ContextChatEngine):
             documents=convert_chat_response_to_documents(
                 chat_response, citations_settings
             ),
-            sources=[
-                ToolOutput(
-                    tool_name="retriever",
-                    content=str(prefix_messages[0]),
-                    raw_input={"message": message},
-                    raw_output=prefix_messages[0],
-                )
-            ],
+            sources=[self._get_retriever_tool_output(message, prefix_messages)],
             source_nodes=nodes,
         )
 
-    @trace_method("chat")
-    def stream_chat(
-        self, message: str, chat_history: Optional[List[ChatMessage]] = None
-    ) -> StreamingAgentCitationsChatResponse:
-        if chat_history is not None:
-            self._memory.set(chat_history)
-        self._memory.put(ChatMessage(content=message, role="user"))
+    def _get_speculative_retriever(self) -> Optional[StagedRetriever]:
+        """Get the staged retriever when achat can dispatch the LLM early."""
+        retriever = self._retriever
+        if (
+            self._speculative
+            and isinstance(retriever, StagedRetriever)
+            and retriever.supports_staged_retrieve()
+        ):
+            return retriever
+        return None
+
+    async def _aspeculative_chat(
+        self, retriever: StagedRetriever, message: str, memory: BaseMemory
+    ) -> AgentCitationsChatResponse:
+        """Chat with a staged retriever, starting the LLM on first-stage nodes.
+
+        The LLM request for the cheap first-stage nodes runs while the retriever
+        refines them. If the refined nodes are the same, its response is used;
+        otherwise it is cancelled and the request is sent again with the
+        refined nodes. KV cache accesses are only counted for the request whose
+        response is used.
+        """
+        memory.put(_to_user_message(message))
+        all_messages = memory.get_all()
+
+        query_bundle = QueryBundle(message)
+        citations_settings = CitationsSettings()
+        stage1_nodes = self._postprocess_nodes(
+            await retriever.astage1(query_bundle), query_bundle
+        )
+        speculative_task = asyncio.create_task(
+            self._llm.achat(
+                all_messages,
+                **self._get_llm_kwargs(
+                    citations_settings,
+                    stage1_nodes,
+                    await self._aconvert_nodes_to_documents_list(stage1_nodes),
+                    record_kv_access=False,
+                ),
+            )
+        )
+        try:
+            nodes = self._postprocess_nodes(
+                await retriever.arefine(query_bundle), query_bundle
+            )
+        except BaseException:
+            await _adiscard_task(speculative_task)
+            raise
 
-        context_str_template, nodes = self._generate_context(message)
+        if [n.node.node_id for n in nodes] == [n.node.node_id for n in stage1_nodes]:
+            chat_response = await speculative_task
+            if self._kv_cache is not None and self._uses_doc_kv_cache():
+                self._kv_cache.record_access(n.node.node_id for n in nodes)
+        else:
+            await _adiscard_task(speculative_task)
+            chat_response = await self._llm.achat(
+                all_messages,
+                **self._get_llm_kwargs(
+                    citations_settings,
+                    nodes,
+                    await self._aconvert_nodes_to_documents_list(nodes),
+                ),
+            )
+        self._update_doc_kv_cache(chat_response, nodes)
+        memory.put(chat_response.message)
+
+        prefix_messages = self._get_prefix_messages_with_context(
+            self._get_context_str(nodes)
+        )
+        return self._build_response(
+            chat_response, message, prefix_messages, nodes, citations_settings
+        )
+
+    def _chat_fast(
+        self, message: str, memory: BaseMemory
+    ) -> AgentCitationsChatResponse:
+        memory.put(_to_user_message(message))
+
+        context_str_template, nodes, documents_list = self._retrieve_context(
+            message, memory
+        )
         prefix_messages = self._get_prefix_messages_with_context(context_str_template)
-        all_messages = self._memory.get_all()
-        documents_list = convert_nodes_to_documents_list(nodes)
+
+        all_messages = memory.get_all()
         # prepare request kwargs
         citations_settings = CitationsSettings()
-        kwargs = {}
-        if citations_settings and citations_settings.documents_request_param:
-            kwargs[citations_settings.documents_request_param] = documents_list
+        kwargs = self._get_llm_kwargs(citations_settings, nodes, documents_list)
         # and then uses an LLM to generate a response
+        chat_response = self._llm.chat(all_messages, **kwargs)
+        self._update_doc_kv_cache(chat_response, nodes)
+        ai_message = chat_response.message
+        memory.put(ai_message)
+
+        return self._build_response(
+            chat_response, message, prefix_messages, nodes, citations_settings
+        )
+
+    def _stream_chat_fast(
+        self, message: str, memory: BaseMemory
+    ) -> StreamingAgentCitationsChatResponse:
+        memory.put(_to_user_message(message))
+
+        context_str_template, nodes, documents_list = self._retrieve_context(
+            message, memory
+        )
+        all_messages = memory.get_all()
+        # prepare request kwargs
+        citations_settings = CitationsSettings()
+        kwargs = self._get_llm_kwargs(citations_settings, nodes, documents_list)
+        # start the LLM request first; the prefix messages are only reported as
+        # the response source, so they are built while the first tokens arrive
+        chat_stream = self._llm.stream_chat(all_messages, **kwargs)
+        prefix_messages = self._get_prefix_messages_with_context(context_str_template)
         chat_response = StreamingAgentCitationsChatResponse(
-            chat_stream=self._llm.stream_chat(all_messages, **kwargs),
+            chat_stream=chat_stream,
             citations_settings=citations_settings,
-            sources=[
-                ToolOutput(
-                    tool_name="retriever",
-                    content=str(prefix_messages[0]),
-                    raw_input={"message": message},
-                    raw_output=prefix_messages[0],
-                )
-            ],
+            stream_batch_settings=self._stream_batch_settings,
+            sources=[self._get_retriever_tool_output(message, prefix_messages)],
             source_nodes=nodes,
         )
-        thread = Thread(
-            target=chat_response.write_response_to_history, args=(self._memory,)
-        )
-        thread.start()
+        _start_stream_writer(chat_response.write_response_to_history, memory)
 
         return chat_response
 
-    @trace_method("chat")
-    async def achat(
-        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    async def _achat_fast(
+        self, message: str, memory: BaseMemory
     ) -> AgentCitationsChatResponse:
-        if chat_history is not None:
-            self._memory.set(chat_history)
-        self._memory.put(ChatMessage(content=message, role="user"))
+        speculative_retriever = self._get_speculative_retriever()
+        if speculative_retriever is not None:
+            return await self._aspeculative_chat(speculative_retriever, message, memory)
+
+        memory.put(_to_user_message(message))
 
-        context_str_template, nodes = await self._agenerate_context(message)
+        context_str_template, nodes, documents_list = await self._aretrieve_context(
+            message, memory
+        )
         prefix_messages = self._get_prefix_messages_with_context(context_str_template)
-        all_messages = self._memory.get_all()
-        documents_list = convert_nodes_to_documents_list(nodes)
+        all_messages = memory.get_all()
         # prepare request kwargs
         citations_settings = CitationsSettings()
-        kwargs = {}
-        if citations_settings and citations_settings.documents_request_param:
-            kwargs[citations_settings.documents_request_param] = documents_list
+        kwargs = self._get_llm_kwargs(citations_settings, nodes, documents_list)
         # and then uses an LLM to generate a response
         chat_response = await self._llm.achat(all_messages, **kwargs)
+        self._update_doc_kv_cache(chat_response, nodes)
         ai_message = chat_response.message
-        self._memory.put(ai_message)
+        memory.put(ai_message)
 
-        return AgentCitationsChatResponse(
-            response=str(chat_response.message.content),
-            citations=convert_chat_response_to_citations(
-                chat_response, citations_settings
-            ),
-            documents=convert_chat_response_to_documents(
-                chat_response, citations_settings
-            ),
-            sources=[
-                ToolOutput(
-                    tool_name="retriever",
-                    content=str(prefix_messages[0]),
-                    raw_input={"message": message},
-                    raw_output=prefix_messages[0],
-                )
-            ],
-            source_nodes=nodes,
+        return self._build_response(
+            chat_response, message, prefix_messages, nodes, citations_settings
         )
 
-    @trace_method("chat")
-    async def astream_chat(
-        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    async def _astream_chat_fast(
+        self, message: str, memory: BaseMemory
     ) -> StreamingAgentCitationsChatResponse:
-        if chat_history is not None:
-            self._memory.set(chat_history)
-        self._memory.put(ChatMessage(content=message, role="user"))
-
-        context_str_template, nodes = await self._agenerate_context(message)
-        prefix_messages = self._get_prefix_messages_with_context(context_str_template)
+        memory.put(_to_user_message(message))
 
-        all_messages = self._memory.get_all()
-        documents_list = convert_nodes_to_documents_list(nodes)
+        context_str_template, nodes, documents_list = await self._aretrieve_context(
+            message, memory
+        )
+        all_messages = memory.get_all()
         # prepare request kwargs
         citations_settings = CitationsSettings()
-        kwargs = {}
-        if citations_settings and citations_settings.documents_request_param:
-            kwargs[citations_settings.documents_request_param] = documents_list
-
+        kwargs = self._get_llm_kwargs(citations_settings, nodes, documents_list)
+        # start the LLM request first; the prefix messages are only reported as
+        # the response source, so they are built while the first tokens arrive
+        achat_stream = await self._llm.astream_chat(all_messages, **kwargs)
+        prefix_messages = self._get_prefix_messages_with_context(context_str_template)
         chat_response = StreamingAgentCitationsChatResponse(
-            achat_stream=await self._llm.astream_chat(all_messages, **kwargs),
+            achat_stream=achat_stream,
             citations_settings=citations_settings,
-            sources=[
-                ToolOutput(
-                    tool_name="retriever",
-                    content=str(prefix_messages[0]),
-                    raw_input={"message": message},
-                    raw_output=prefix_messages[0],
-                )
-            ],
+            stream_batch_settings=self._stream_batch_settings,
+            sources=[self._get_retriever_tool_output(message, prefix_messages)],
             source_nodes=nodes,
         )
-        loop = asyncio.get_event_loop()
-        thread = Thread(
-            target=lambda x: loop.create_task(
-                chat_response.awrite_response_to_history(x)
-            ),
-            args=(self._memory,),
-        )
-        thread.start()
+        _schedule_history_write(chat_response.awrite_response_to_history(memory))
 
         return chat_response
+
+    @trace_method("chat")
+    def chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> AgentCitationsChatResponse:
+        memory = self._memory
+        if chat_history is not None:
+            memory.set(chat_history)
+        return self._chat_fast(message, memory)
+
+    @trace_method("chat")
+    def chat_with(
+        self,
+        message: str,
+        memory: Optional[BaseMemory] = None,
+        chat_history: Optional[List[ChatMessage]] = None,
+    ) -> AgentCitationsChatResponse:
+        """Like `chat`, but reading and writing the given chat memory.
+
+        Without a memory, the engine's own memory is used.
+        """
+        memory = self._memory_for(memory)
+        if chat_history is not None:
+            memory.set(chat_history)
+        return self._chat_fast(message, memory)
+
+    @trace_method("chat")
+    def stream_chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> StreamingAgentCitationsChatResponse:
+        memory = self._memory
+        if chat_history is not None:
+            memory.set(chat_history)
+        return self._stream_chat_fast(message, memory)
+
+    @trace_method("chat")
+    def stream_chat_with(
+        self,
+        message: str,
+        memory: Optional[BaseMemory] = None,
+        chat_history: Optional[List[ChatMessage]] = None,
+    ) -> StreamingAgentCitationsChatResponse:
+        """Like `stream_chat`, but reading and writing the given chat memory.
+
+        Without a memory, the engine's own memory is used.
+        """
+        memory = self._memory_for(memory)
+        if chat_history is not None:
+            memory.set(chat_history)
+        return self._stream_chat_fast(message, memory)
+
+    @trace_method("chat")
+    async def achat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> AgentCitationsChatResponse:
+        memory = self._memory
+        if chat_history is not None:
+            memory.set(chat_history)
+        return await self._achat_fast(message, memory)
+
+    @trace_method("chat")
+    async def achat_with(
+        self,
+        message: str,
+        memory: Optional[BaseMemory] = None,
+        chat_history: Optional[List[ChatMessage]] = None,
+    ) -> AgentCitationsChatResponse:
+        """Like `achat`, but reading and writing the given chat memory.
+
+        Without a memory, the engine's own memory is used.
+        """
+        memory = self._memory_for(memory)
+        if chat_history is not None:
+            memory.set(chat_history)
+        return await self._achat_fast(message, memory)
+
+    @trace_method("chat")
+    async def astream_chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> StreamingAgentCitationsChatResponse:
+        memory = self._memory
+        if chat_history is not None:
+            memory.set(chat_history)
+        return await self._astream_chat_fast(message, memory)
+
+    @trace_method("chat")
+    async def astream_chat_with(
+        self,
+        message: str,
+        memory: Optional[BaseMemory] = None,
+        chat_history: Optional[List[ChatMessage]] = None,
+    ) -> StreamingAgentCitationsChatResponse:
+        """Like `astream_chat`, but reading and writing the given chat memory.
+
+        Without a memory, the engine's own memory is used.
+        """
+        memory = self._memory_for(memory)
+        if chat_history is not None:
+            memory.set(chat_history)
+        return await self._astream_chat_fast(message, memory)
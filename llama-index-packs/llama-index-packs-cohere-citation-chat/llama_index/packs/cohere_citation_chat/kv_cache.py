@@ -0,0 +1,143 @@
+import logging
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_KV_CACHE_CAPACITY = 1 << 30
+
+
+def _get_blob_size(blob: Any) -> Optional[int]:
+    """Get the size of a KV block in bytes, or None if it cannot be measured."""
+    nbytes = getattr(blob, "nbytes", None)  # numpy arrays, tensors, memoryviews
+    if isinstance(nbytes, int):
+        return nbytes
+    try:
+        return memoryview(blob).nbytes
+    except TypeError:
+        return None
+
+
+@dataclass
+class _KVEntry:
+    blob: Any
+    size: int
+    cost: float
+    frequency: int = 1
+    priority: float = 0.0
+
+
+class CohereDocKVCache:
+    """Host-memory cache of precomputed KV blocks, keyed by document id.
+
+    Used by the citations chat engine with LLMs that set
+    `supports_doc_kv_cache = True`: the fingerprints of the retrieved documents
+    and the cached KV blocks for them are sent with the request, and KV blocks
+    returned in the response `raw["doc_kv_blocks"]` are stored for later turns.
+
+    Eviction follows a PGDSF-style (Prefix-aware Greedy-Dual-Size-Frequency)
+    priority, `clock + frequency * cost / size`, so blocks that are reused
+    often and are expensive to recompute relative to their size stay resident.
+
+    Args:
+        capacity (int): Total size of the cached blocks, in bytes.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_KV_CACHE_CAPACITY) -> None:
+        self.capacity = capacity
+        self._entries: Dict[str, _KVEntry] = {}
+        self._size = 0
+        self._clock = 0.0
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_many(
+        self, doc_ids: Iterable[str], record_access: bool = True
+    ) -> Dict[str, Any]:
+        """Get the cached KV blocks for the given document ids.
+
+        Args:
+            doc_ids (Iterable[str]): Document ids.
+            record_access (bool): Count the lookup as an access to the blocks.
+                Pass False for requests whose response may be discarded, and
+                call `record_access` once it is used.
+        """
+        blobs = {}
+        with self._lock:
+            for doc_id in doc_ids:
+                entry = self._entries.get(doc_id)
+                if entry is None:
+                    continue
+                if record_access:
+                    self._record_access(entry)
+                blobs[doc_id] = entry.blob
+        return blobs
+
+    def record_access(self, doc_ids: Iterable[str]) -> None:
+        """Count an access to the cached KV blocks for the given document ids."""
+        with self._lock:
+            for doc_id in doc_ids:
+                entry = self._entries.get(doc_id)
+                if entry is not None:
+                    self._record_access(entry)
+
+    def put(
+        self, doc_id: str, blob: Any, cost: float = 1.0, size: Optional[int] = None
+    ) -> None:
+        """Store the KV block for a document.
+
+        Args:
+            doc_id (str): Document id.
+            blob (Any): Opaque KV block returned by the LLM.
+            cost (float): Cost of recomputing the block, e.g. its token count.
+            size (Optional[int]): Size of the block in bytes. Defaults to the
+                `nbytes` of arrays and tensors or the length of a buffer;
+                blocks without either are not cached.
+        """
+        if size is None:
+            size = _get_blob_size(blob)
+            if size is None:
+                logger.warning(
+                    f"Not caching KV block for document {doc_id!r}: "
+                    f"cannot measure the size of {type(blob).__name__}."
+                )
+                return
+        if size > self.capacity:
+            return
+        with self._lock:
+            previous = self._entries.pop(doc_id, None)
+            frequency = 1
+            if previous is not None:
+                # the turn that refreshes a block already counted its access
+                # in get_many
+                self._size -= previous.size
+                frequency = previous.frequency
+            entry = _KVEntry(blob=blob, size=size, cost=cost, frequency=frequency)
+            entry.priority = self._get_priority(entry)
+            self._entries[doc_id] = entry
+            self._size += size
+            while self._size > self.capacity:
+                self._evict()
+
+    def clear(self) -> None:
+        """Remove all blocks."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._clock = 0.0
+
+    def _record_access(self, entry: _KVEntry) -> None:
+        entry.frequency += 1
+        entry.priority = self._get_priority(entry)
+
+    def _get_priority(self, entry: _KVEntry) -> float:
+        return self._clock + entry.frequency * entry.cost / max(entry.size, 1)
+
+    def _evict(self) -> None:
+        doc_id = min(self._entries, key=lambda k: self._entries[k].priority)
+        entry = self._entries.pop(doc_id)
+        self._size -= entry.size
+        self._clock = entry.priority
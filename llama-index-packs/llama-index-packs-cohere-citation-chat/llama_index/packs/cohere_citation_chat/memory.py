@@ -0,0 +1,67 @@
+from threading import Lock
+from typing import Any, List, Optional
+
+from llama_index.core.base.llms.types import ChatMessage
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.llms.llm import LLM
+from llama_index.core.memory import BaseMemory, ChatMemoryBuffer
+
+
+class CachedMemory(BaseMemory):
+    """Memory wrapper that keeps the full chat history in process.
+
+    `get_all` is served from a local list that is appended to on `put`, so
+    memories backed by a remote chat store are not re-read on every turn.
+    All writes must go through the wrapper for the cached history to stay
+    correct.
+    """
+
+    memory: BaseMemory = Field(description="Wrapped memory.")
+
+    _all_cache: Optional[List[ChatMessage]] = PrivateAttr(default=None)
+    _lock: Lock = PrivateAttr(default_factory=Lock)
+
+    @classmethod
+    def class_name(cls) -> str:
+        """Get class name."""
+        return "CachedMemory"
+
+    @classmethod
+    def from_defaults(
+        cls,
+        chat_history: Optional[List[ChatMessage]] = None,
+        llm: Optional[LLM] = None,
+    ) -> "CachedMemory":
+        """Create a cached chat memory buffer."""
+        return cls(memory=ChatMemoryBuffer.from_defaults(chat_history, llm=llm))
+
+    def get(self, **kwargs: Any) -> List[ChatMessage]:
+        """Get chat history."""
+        return self.memory.get(**kwargs)
+
+    def get_all(self) -> List[ChatMessage]:
+        """Get all chat history."""
+        with self._lock:
+            if self._all_cache is None:
+                # copy, since the wrapped memory may hand out its own list
+                self._all_cache = list(self.memory.get_all())
+            return self._all_cache
+
+    def put(self, message: ChatMessage) -> None:
+        """Put chat history."""
+        with self._lock:
+            self.memory.put(message)
+            if self._all_cache is not None:
+                self._all_cache.append(message)
+
+    def set(self, messages: List[ChatMessage]) -> None:
+        """Set chat history."""
+        with self._lock:
+            self.memory.set(messages)
+            self._all_cache = None
+
+    def reset(self) -> None:
+        """Reset chat history."""
+        with self._lock:
+            self.memory.reset()
+            self._all_cache = []
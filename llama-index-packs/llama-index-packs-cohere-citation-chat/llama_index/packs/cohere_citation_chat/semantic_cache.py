@@ -0,0 +1,202 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from hashlib import blake2b
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.base.llms.types import ChatMessage
+from llama_index.core.schema import NodeWithScore
+
+DEFAULT_TTL = 300.0
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+DEFAULT_NUM_BITS = 64
+DEFAULT_NUM_BANDS = 4
+
+
+@dataclass
+class CachedContext:
+    """Retrieval result cached for a chat message."""
+
+    context_str: str
+    nodes: List[NodeWithScore]
+    documents_list: List[Dict[str, Any]]
+    embedding: Optional[Embedding] = None
+    history_key: str = ""
+    expires_at: float = field(default=0.0)
+
+
+class SemanticContextCache:
+    """Two-tier cache for the retrieval step of a citations chat engine.
+
+    The first tier is keyed by a hash of the normalized message (plus,
+    optionally, the last `history_window` chat messages), so exact repeats skip
+    both the embedding and the retriever call. The second tier is a
+    random-projection LSH index over query embeddings: near-duplicate messages
+    whose cosine similarity with a cached query is at least
+    `similarity_threshold`, and whose last `history_window` messages are the
+    same, reuse its context. The second tier is only used
+    when an `embed_model` is given; it should be the same model the retriever
+    embeds queries with, so the query embedding is computed once and handed to
+    the retriever on a miss.
+
+    Args:
+        embed_model (Optional[BaseEmbedding]): Model used to embed queries for
+            the similarity tier.
+        ttl (float): Seconds an entry stays valid.
+        max_size (int): Maximum number of cached entries (LRU eviction).
+        similarity_threshold (float): Minimum cosine similarity for a
+            near-duplicate hit.
+        history_window (int): Number of previous chat messages (not turns: a
+            user message and its reply are two messages) that must match for
+            a cache hit, in either tier.
+        num_bits (int): Number of random hyperplanes in the LSH signature.
+        num_bands (int): Number of bands the signature is split into.
+        seed (int): Seed for the random hyperplanes.
+    """
+
+    def __init__(
+        self,
+        embed_model: Optional[BaseEmbedding] = None,
+        ttl: float = DEFAULT_TTL,
+        max_size: int = DEFAULT_MAX_SIZE,
+        similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+        history_window: int = 0,
+        num_bits: int = DEFAULT_NUM_BITS,
+        num_bands: int = DEFAULT_NUM_BANDS,
+        seed: int = 0,
+    ) -> None:
+        if num_bits % num_bands != 0:
+            raise ValueError("num_bits must be divisible by num_bands.")
+        self.embed_model = embed_model
+        self.ttl = ttl
+        self.max_size = max_size
+        self.similarity_threshold = similarity_threshold
+        self.history_window = history_window
+        self._num_bits = num_bits
+        self._num_bands = num_bands
+        self._seed = seed
+        self._projection: Optional[np.ndarray] = None
+        self._entries: "OrderedDict[str, CachedContext]" = OrderedDict()
+        self._bands: Dict[Tuple[int, bytes], Set[str]] = {}
+        self._signatures: Dict[str, List[Tuple[int, bytes]]] = {}
+        self._lock = Lock()
+
+    def get_history_key(self, history: Sequence[ChatMessage] = ()) -> str:
+        """Get the digest of the last `history_window` messages ("" if unused)."""
+        if self.history_window <= 0:
+            return ""
+        hasher = blake2b(digest_size=16)
+        for chat_message in history[-self.history_window :]:
+            hasher.update(b"\x00")
+            hasher.update(str(chat_message.role).encode("utf-8"))
+            hasher.update(b"\x00")
+            hasher.update(str(chat_message.content or "").encode("utf-8"))
+        return hasher.hexdigest()
+
+    def get_key(self, message: str, history_key: str = "") -> str:
+        """Get the exact-match key for a message and its history key."""
+        hasher = blake2b(message.strip().lower().encode("utf-8"), digest_size=16)
+        hasher.update(history_key.encode("utf-8"))
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> Optional[CachedContext]:
+        """Get an exact-match entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def get_similar(
+        self, embedding: Embedding, history_key: str = ""
+    ) -> Optional[CachedContext]:
+        """Get the most similar entry above the similarity threshold.
+
+        Only entries cached with the same `history_key` are considered.
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query)
+        if query_norm == 0:
+            return None
+        with self._lock:
+            candidates: Set[str] = set()
+            for band in self._get_signature(query):
+                candidates.update(self._bands.get(band, ()))
+
+            now = time.monotonic()
+            best_key, best_score = None, self.similarity_threshold
+            for key in candidates:
+                entry = self._entries[key]
+                if entry.expires_at < now:
+                    self._remove(key)
+                    continue
+                if entry.history_key != history_key:
+                    continue
+                cached = np.asarray(entry.embedding, dtype=np.float32)
+                score = float(
+                    np.dot(query, cached) / (query_norm * np.linalg.norm(cached))
+                )
+                if score >= best_score:
+                    best_key, best_score = key, score
+
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key]
+
+    def put(self, key: str, entry: CachedContext) -> None:
+        """Add an entry, indexing its embedding for similarity lookups."""
+        entry.expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            if entry.embedding is not None:
+                signature = self._get_signature(
+                    np.asarray(entry.embedding, dtype=np.float32)
+                )
+                self._signatures[key] = signature
+                for band in signature:
+                    self._bands.setdefault(band, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._bands.clear()
+            self._signatures.clear()
+
+    def _get_signature(self, embedding: np.ndarray) -> List[Tuple[int, bytes]]:
+        if self._projection is None or len(self._projection[0]) != len(embedding):
+            rng = np.random.default_rng(self._seed)
+            self._projection = rng.standard_normal(
+                (self._num_bits, len(embedding))
+            ).astype(np.float32)
+            self._bands.clear()
+            self._signatures.clear()
+        bits = self._projection @ embedding > 0
+        band_size = self._num_bits // self._num_bands
+        return [
+            (i, np.packbits(bits[i * band_size : (i + 1) * band_size]).tobytes())
+            for i in range(self._num_bands)
+        ]
+
+    def _remove(self, key: str) -> None:
+        self._entries.pop(key, None)
+        for band in self._signatures.pop(key, ()):
+            keys = self._bands.get(band)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._bands[band]
@@ -0,0 +1,26 @@
+from abc import abstractmethod
+from typing import List
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+
+class StagedRetriever(BaseRetriever):
+    """Retriever with a cheap first stage and a slower refinement stage.
+
+    Used by the citations chat engine with `speculative=True`: `achat` starts
+    the LLM request on the `astage1` nodes while `arefine` runs, and only sends
+    it again if the refined nodes differ (by node id, in order).
+    """
+
+    def supports_staged_retrieve(self) -> bool:
+        """Whether staged retrieval can be used, e.g. for this configuration."""
+        return True
+
+    @abstractmethod
+    async def astage1(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Retrieve the first-stage nodes for a query."""
+
+    @abstractmethod
+    async def arefine(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        """Retrieve the refined nodes for a query."""
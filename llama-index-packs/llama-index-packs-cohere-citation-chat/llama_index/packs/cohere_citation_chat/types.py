@@ -35,3 +35,22 @@ class CitationsSettings:
     citations_stream_event_type: str = field(default="citation-generation")
 
     dict = asdict
+
+
+@dataclass
+class StreamBatchSettings:
+    """Settings for batching streamed tokens into the response queue.
+
+    Batches start at `initial_batch_size` tokens and grow by `growth_factor`
+    after every flush, up to `max_batch_size`. A smaller batch is also flushed
+    when a token arrives `flush_interval` seconds or more after the previous
+    flush. There is no timer: pending tokens wait for the next token, or for
+    the end of the stream, however long that takes.
+    """
+
+    initial_batch_size: int = field(default=1)
+    growth_factor: int = field(default=3)
+    max_batch_size: int = field(default=50)
+    flush_interval: float = field(default=0.05)
+
+    dict = asdict
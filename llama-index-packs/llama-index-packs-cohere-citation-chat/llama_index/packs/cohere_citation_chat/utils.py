@@ -1,13 +1,27 @@
+from collections import OrderedDict
 from dataclasses import asdict
-from typing import List
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
 
 from llama_index.core.base.llms.types import ChatResponse
 from llama_index.core.schema import NodeWithScore
 
 from .types import Document, Citation, CitationsSettings
 
+DOCUMENTS_LIST_CACHE_SIZE = 1024
 
-def convert_nodes_to_documents_list(nodes: List[NodeWithScore]) -> List[Document]:
+# (node_id, text) pairs of the converted nodes
+DocumentsListKey = Tuple[Tuple[str, str], ...]
+
+_documents_list_cache: "OrderedDict[DocumentsListKey, List[Dict[str, Any]]]" = (
+    OrderedDict()
+)
+_documents_list_cache_lock = Lock()
+
+
+def convert_nodes_to_documents_list(
+    nodes: List[NodeWithScore],
+) -> List[Dict[str, Any]]:
     if nodes:
         return [
             asdict(Document(id=node.node_id, text=node.get_text())) for node in nodes
@@ -15,43 +29,74 @@ def convert_nodes_to_documents_list(nodes: List[NodeWithScore]) -> List[Document
     return []
 
 
+def get_cached_documents_list(
+    nodes: List[NodeWithScore],
+) -> Optional[List[Dict[str, Any]]]:
+    """Get the cached documents list for the nodes, if they were converted before.
+
+    The returned list is shared between calls with the same nodes and must not
+    be mutated.
+    """
+    key = tuple((node.node_id, node.get_text()) for node in nodes)
+    with _documents_list_cache_lock:
+        documents_list = _documents_list_cache.get(key)
+        if documents_list is not None:
+            _documents_list_cache.move_to_end(key)
+        return documents_list
+
+
+def convert_nodes_to_documents_list_cached(
+    nodes: List[NodeWithScore],
+) -> List[Dict[str, Any]]:
+    """Convert nodes to a documents list, reusing the list for repeated nodes.
+
+    The returned list is shared between calls with the same nodes and must not
+    be mutated.
+    """
+    cached_documents_list = get_cached_documents_list(nodes)
+    if cached_documents_list is not None:
+        return cached_documents_list
+
+    key = tuple((node.node_id, node.get_text()) for node in nodes)
+    documents_list = convert_nodes_to_documents_list(nodes)
+    with _documents_list_cache_lock:
+        _documents_list_cache[key] = documents_list
+        if len(_documents_list_cache) > DOCUMENTS_LIST_CACHE_SIZE:
+            _documents_list_cache.popitem(last=False)
+    return documents_list
+
+
 def convert_chat_response_to_citations(
     chat_response: ChatResponse, citations_settings: CitationsSettings
 ) -> List[Citation]:
-    if (
-        chat_response
-        and chat_response.raw
-        and chat_response.raw.get(citations_settings.citations_response_field, None)
-    ):
-        return [
-            Citation(
-                text=citation.get("text"),
-                start=citation.get("start"),
-                end=citation.get("end"),
-                document_ids=citation.get("document_ids"),
-            )
-            for citation in chat_response.raw[
-                citations_settings.citations_response_field
-            ]
-        ]
-    return []
+    if not chat_response or not chat_response.raw:
+        return []
+    citations = chat_response.raw.get(citations_settings.citations_response_field)
+    if not citations:
+        return []
+    return [
+        Citation(
+            text=citation.get("text"),
+            start=citation.get("start"),
+            end=citation.get("end"),
+            document_ids=citation.get("document_ids"),
+        )
+        for citation in citations
+    ]
 
 
 def convert_chat_response_to_documents(
     chat_response: ChatResponse, citations_settings: CitationsSettings
 ) -> List[Document]:
-    if (
-        chat_response
-        and chat_response.raw
-        and chat_response.raw.get(citations_settings.documents_response_field, None)
-    ):
-        return [
-            Document(
-                id=document.get("id"),
-                text=document.get("text"),
-            )
-            for document in chat_response.raw[
-                citations_settings.documents_response_field
-            ]
-        ]
-    return []
+    if not chat_response or not chat_response.raw:
+        return []
+    documents = chat_response.raw.get(citations_settings.documents_response_field)
+    if not documents:
+        return []
+    return [
+        Document(
+            id=document.get("id"),
+            text=document.get("text"),
+        )
+        for document in documents
+    ]
@@ -1,7 +1,540 @@
+import asyncio
+import gc
+import threading
+
+import numpy as np
+import pytest
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse, MessageRole
+from llama_index.core.embeddings import MockEmbedding
 from llama_index.core.llama_pack import BaseLlamaPack
-from llama_index.packs.cohere_citation_chat import CohereCitationChatEnginePack
+from llama_index.core.llms import MockLLM
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.packs.cohere_citation_chat import (
+    CachedMemory,
+    CitationsContextChatEngine,
+    CohereCitationChatEnginePack,
+    CohereDocKVCache,
+    SemanticContextCache,
+    StagedRetriever,
+)
+from llama_index.packs.cohere_citation_chat import citations_context_chat_engine
+from llama_index.packs.cohere_citation_chat.citations_context_chat_engine import (
+    DEFAULT_STREAM_POOL_SIZE,
+    StreamingAgentCitationsChatResponse,
+    _get_stream_pool_size,
+    _start_stream_writer,
+    _split_context_template,
+    _TokenBatcher,
+    _to_user_message,
+)
+from llama_index.packs.cohere_citation_chat.semantic_cache import CachedContext
+from llama_index.packs.cohere_citation_chat.types import StreamBatchSettings
+from llama_index.packs.cohere_citation_chat.utils import (
+    convert_nodes_to_documents_list_cached,
+    get_cached_documents_list,
+)
+
+
+class _Retriever(BaseRetriever):
+    """Retriever returning one node per query, counting its calls."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls = 0
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        self.calls += 1
+        node = TextNode(id_=f"n{self.calls}", text=query_bundle.query_str)
+        return [NodeWithScore(node=node, score=1.0)]
+
+
+def _memory(chat_history: Optional[List[ChatMessage]] = None) -> ChatMemoryBuffer:
+    return ChatMemoryBuffer.from_defaults(
+        chat_history=chat_history, token_limit=1000, tokenizer_fn=str.split
+    )
 
 
 def test_class():
     names_of_base_classes = [b.__name__ for b in CohereCitationChatEnginePack.__mro__]
     assert BaseLlamaPack.__name__ in names_of_base_classes
+
+
+def test_semantic_context_cache():
+    cache = SemanticContextCache(similarity_threshold=0.9)
+    entry = CachedContext(
+        context_str="context", nodes=[], documents_list=[], embedding=[1.0, 0.0, 0.5]
+    )
+    cache.put(cache.get_key("What is LlamaIndex?"), entry)
+
+    # exact match ignores case and surrounding whitespace
+    assert cache.get(cache.get_key("  what is llamaindex? ")) is entry
+    assert cache.get(cache.get_key("What is a llama?")) is None
+
+    # near-duplicate embeddings hit the similarity tier
+    assert cache.get_similar([1.0, 0.01, 0.5]) is entry
+    assert cache.get_similar([-1.0, 1.0, 0.0]) is None
+
+    cache.clear()
+    assert cache.get(cache.get_key("What is LlamaIndex?")) is None
+
+
+def test_semantic_context_cache_history_key():
+    cache = SemanticContextCache(history_window=2)
+    stocks = cache.get_history_key([ChatMessage(content="about the stock market")])
+    llamas = cache.get_history_key([ChatMessage(content="about llamas")])
+    assert stocks != llamas
+    assert cache.get_key("tell me more", stocks) != cache.get_key(
+        "tell me more", llamas
+    )
+
+    entry = CachedContext(
+        context_str="LLAMA CTX",
+        nodes=[],
+        documents_list=[],
+        embedding=[1.0, 0.0, 0.5],
+        history_key=llamas,
+    )
+    cache.put(cache.get_key("tell me more", llamas), entry)
+    # the same message in another conversation does not reuse the context
+    assert cache.get_similar([1.0, 0.0, 0.5], stocks) is None
+    assert cache.get_similar([1.0, 0.0, 0.5], llamas) is entry
+
+    assert (
+        SemanticContextCache().get_history_key([ChatMessage(content="about llamas")])
+        == ""
+    )
+
+
+def test_context_cache_is_scoped_to_history():
+    retriever = _Retriever()
+    engine = CitationsContextChatEngine.from_defaults(
+        retriever,
+        llm=MockLLM(),
+        memory=_memory(),
+        context_cache=SemanticContextCache(
+            embed_model=MockEmbedding(embed_dim=8), history_window=2
+        ),
+    )
+    llamas = [ChatMessage(content="about llamas")]
+    stocks = [ChatMessage(content="about the stock market")]
+
+    engine.chat_with("tell me more", _memory(), chat_history=list(llamas))
+    assert retriever.calls == 1
+    # every query embeds the same, but the conversation is different
+    response = engine.chat_with("tell me more", _memory(), chat_history=list(stocks))
+    assert retriever.calls == 2
+    assert response.source_nodes[0].node.node_id == "n2"
+    # an exact repeat in the same conversation is served from the cache
+    response = engine.chat_with("tell me more", _memory(), chat_history=list(stocks))
+    assert retriever.calls == 2
+    assert response.source_nodes[0].node.node_id == "n2"
+
+
+def test_convert_nodes_to_documents_list_cached():
+    nodes = [NodeWithScore(node=TextNode(id_="1", text="one"), score=1.0)]
+    assert get_cached_documents_list(nodes) is None
+    documents_list = convert_nodes_to_documents_list_cached(nodes)
+    assert documents_list == [{"id": "1", "text": "one"}]
+    assert convert_nodes_to_documents_list_cached(nodes) is documents_list
+    assert get_cached_documents_list(nodes) is documents_list
+
+    changed = [NodeWithScore(node=TextNode(id_="1", text="uno"), score=1.0)]
+    assert convert_nodes_to_documents_list_cached(changed) == [
+        {"id": "1", "text": "uno"}
+    ]
+
+
+def test_cohere_doc_kv_cache_eviction():
+    kv_cache = CohereDocKVCache(capacity=8)
+    kv_cache.put("hot", b"1234", cost=4.0)
+    kv_cache.put("cold", b"1234", cost=1.0)
+    assert kv_cache.get_many(["hot", "missing"]) == {"hot": b"1234"}
+
+    # the cheap, rarely used block is evicted first
+    kv_cache.put("new", b"1234", cost=2.0)
+    assert len(kv_cache) == 2
+    assert set(kv_cache.get_many(["hot", "cold", "new"])) == {"hot", "new"}
+
+
+def test_cohere_doc_kv_cache_measures_blob_size():
+    kv_cache = CohereDocKVCache(capacity=1000)
+    for i in range(50):
+        kv_cache.put(f"doc{i}", np.zeros(125, dtype=np.float64), cost=1.0)
+    # each array holds 1000 bytes, so only one fits
+    assert len(kv_cache) == 1
+
+    kv_cache.put("sized", object(), size=10)
+    assert "sized" in kv_cache.get_many(["sized"])
+    # blocks of unknown size are not cached
+    kv_cache.put("unknown", object())
+    assert kv_cache.get_many(["unknown"]) == {}
+
+
+def test_cohere_doc_kv_cache_counts_one_access_per_turn():
+    kv_cache = CohereDocKVCache(capacity=8)
+    kv_cache.put("reused", b"1234", cost=1.0)
+    kv_cache.put("other", b"1234", cost=2.5)
+    # a turn reads the cached block and stores the block returned by the LLM
+    kv_cache.get_many(["reused"])
+    kv_cache.put("reused", b"1234", cost=1.0)
+
+    # two accesses at cost 1 still rank below one access at cost 2.5
+    kv_cache.put("new", b"1234", cost=10.0)
+    assert set(kv_cache.get_many(["reused", "other", "new"])) == {"other", "new"}
+
+
+def test_cached_memory():
+    inner = ChatMemoryBuffer.from_defaults(token_limit=1000, tokenizer_fn=str.split)
+    memory = CachedMemory(memory=inner)
+    memory.put(ChatMessage(content="hi", role="user"))
+    history = memory.get_all()
+    assert memory.get_all() is history
+
+    memory.put(ChatMessage(content="hello", role="assistant"))
+    assert [m.content for m in memory.get_all()] == ["hi", "hello"]
+    assert [m.content for m in inner.get_all()] == ["hi", "hello"]
+
+    memory.set([ChatMessage(content="reset", role="user")])
+    assert [m.content for m in memory.get_all()] == ["reset"]
+
+    memory.reset()
+    assert memory.get_all() == []
+    assert inner.get_all() == []
+
+
+def test_astream_chat_writes_history_when_consumed_late():
+    engine = CitationsContextChatEngine.from_defaults(
+        _Retriever(), llm=MockLLM(max_tokens=3), memory=_memory()
+    )
+
+    async def astream_chat() -> str:
+        response = await engine.astream_chat("hi")
+        # the history writer starts before the response generator is iterated
+        await asyncio.sleep(0.01)
+        return "".join([delta async for delta in response.async_response_gen()])
+
+    assert asyncio.run(astream_chat()) == "text text text "
+    assert [m.content for m in engine.chat_history] == ["hi", "text text text"]
+
+
+def _chat_stream(
+    deltas: List[str], error: Optional[Exception] = None
+) -> Iterator[ChatResponse]:
+    text = ""
+    for delta in deltas:
+        text += delta
+        yield ChatResponse(
+            message=ChatMessage(content=text, role="assistant"), delta=delta
+        )
+    if error is not None:
+        raise error
+
+
+def test_token_batcher():
+    # no time-based flushes, so batches only depend on their size
+    batcher = _TokenBatcher(StreamBatchSettings(flush_interval=float("inf")))
+    batch_sizes = []
+    for _ in range(150):
+        batch = batcher.add("a")
+        if batch:
+            batch_sizes.append(len(batch))
+    assert batch_sizes == [1, 3, 9, 27, 50, 50]
+    assert batcher.add("") is None
+    assert batcher.flush() == "a" * 10
+    assert batcher.flush() is None
+
+
+def test_write_response_to_history_flushes_last_batch():
+    settings = StreamBatchSettings(flush_interval=float("inf"))
+
+    memory = _memory()
+    response = StreamingAgentCitationsChatResponse(
+        chat_stream=_chat_stream(list("abcde")), stream_batch_settings=settings
+    )
+    response.write_response_to_history(memory)
+    assert list(response.response_gen) == ["a", "bcd", "e"]
+    assert [m.content for m in memory.get_all()] == ["abcde"]
+
+    # the tokens streamed before an error are still delivered
+    memory = _memory()
+    response = StreamingAgentCitationsChatResponse(
+        chat_stream=_chat_stream(list("abcde"), error=RuntimeError("stream")),
+        stream_batch_settings=settings,
+    )
+    response.write_response_to_history(memory)
+    assert list(response.response_gen) == ["a", "bcd", "e"]
+    assert memory.get_all() == []
+
+
+def test_prefix_messages_are_reused_for_the_same_context():
+    extra = ChatMessage(content="Be brief.", role=MessageRole.USER)
+    engine = CitationsContextChatEngine.from_defaults(
+        _Retriever(),
+        llm=MockLLM(),
+        memory=_memory(),
+        prefix_messages=[
+            ChatMessage(content=" You are helpful. ", role=MessageRole.SYSTEM),
+            extra,
+        ],
+    )
+    prefix_messages = engine._get_prefix_messages_with_context("context")
+    assert [(m.role, m.content) for m in prefix_messages] == [
+        (MessageRole.SYSTEM, "You are helpful.\ncontext"),
+        (MessageRole.USER, "Be brief."),
+    ]
+    assert engine._get_prefix_messages_with_context("context") is prefix_messages
+
+    other_prefix_messages = engine._get_prefix_messages_with_context("other")
+    assert other_prefix_messages is not prefix_messages
+    assert other_prefix_messages[0].content == "You are helpful.\nother"
+    assert other_prefix_messages[1] is extra
+
+
+def test_split_context_template():
+    for template in [
+        "Context information is below.\n{context_str}\nAnswer the question.",
+        "{context_str}",
+        "{{literal braces}} {context_str} {{ and more }}",
+    ]:
+        prefix, suffix = _split_context_template(template)
+        assert prefix + "ctx {}" + suffix == template.format(context_str="ctx {}")
+
+    # templates that need str.format are not split
+    for template in [
+        "{context_str!r}",
+        "{context_str:>20}",
+        "{context_str} {context_str}",
+        "{other} {context_str}",
+        "no fields",
+    ]:
+        assert _split_context_template(template) is None
+
+    # the engine renders both kinds the same way as str.format
+    nodes = [NodeWithScore(node=TextNode(id_="1", text="one"), score=1.0)]
+    for template in ["{{ {context_str} }}", "{context_str!r}"]:
+        engine = CitationsContextChatEngine.from_defaults(
+            _Retriever(), llm=MockLLM(), memory=_memory(), context_template=template
+        )
+        assert engine._get_context_str(nodes) == template.format(context_str="one")
+
+
+def _nodes(node_ids: List[str]) -> List[NodeWithScore]:
+    return [
+        NodeWithScore(node=TextNode(id_=node_id, text=node_id), score=1.0)
+        for node_id in node_ids
+    ]
+
+
+class _StagedRetriever(StagedRetriever):
+    """Staged retriever whose refinement returns the given node ids."""
+
+    def __init__(self, refined_ids: List[str]) -> None:
+        super().__init__()
+        self.refined_ids = refined_ids
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return _nodes(self.refined_ids)
+
+    async def astage1(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return _nodes(["a", "b"])
+
+    async def arefine(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        await asyncio.sleep(0.01)
+        return _nodes(self.refined_ids)
+
+
+class _SlowLLM(MockLLM):
+    """LLM recording the documents of each request and its cancellations."""
+
+    _requests: List[List[str]] = PrivateAttr(default_factory=list)
+    _cancelled: List[List[str]] = PrivateAttr(default_factory=list)
+    _fail_on_cancel: bool = PrivateAttr(default=False)
+
+    @property
+    def supports_doc_kv_cache(self) -> bool:
+        return True
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> Any:
+        document_ids = [document["id"] for document in kwargs["documents"]]
+        self._requests.append(document_ids)
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            self._cancelled.append(document_ids)
+            if self._fail_on_cancel:
+                raise RuntimeError("request failed while cancelled")
+            raise
+        return await super().achat(messages, **kwargs)
+
+
+def _speculative_engine(
+    refined_ids: List[str], **kwargs: Any
+) -> Tuple[CitationsContextChatEngine, _SlowLLM]:
+    llm = _SlowLLM()
+    engine = CitationsContextChatEngine.from_defaults(
+        _StagedRetriever(refined_ids),
+        llm=llm,
+        memory=_memory(),
+        speculative=True,
+        **kwargs,
+    )
+    return engine, llm
+
+
+def test_speculative_achat_uses_first_stage_response():
+    engine, llm = _speculative_engine(["a", "b"])
+    response = asyncio.run(engine.achat("hi"))
+
+    assert llm._requests == [["a", "b"]]
+    assert llm._cancelled == []
+    assert [n.node.node_id for n in response.source_nodes] == ["a", "b"]
+    assert [m.role for m in engine.chat_history] == ["user", "assistant"]
+
+
+def test_speculative_achat_resends_for_refined_nodes():
+    engine, llm = _speculative_engine(["b", "c"])
+    response = asyncio.run(engine.achat("hi"))
+
+    # the first-stage request is cancelled and sent again with the refined nodes
+    assert llm._requests == [["a", "b"], ["b", "c"]]
+    assert llm._cancelled == [["a", "b"]]
+    assert [n.node.node_id for n in response.source_nodes] == ["b", "c"]
+    assert [m.role for m in engine.chat_history] == ["user", "assistant"]
+
+
+def test_shared_engine_keeps_session_histories_apart():
+    retriever, llm = _Retriever(), MockLLM(max_tokens=1)
+    engine = CitationsContextChatEngine.from_shared(retriever, llm, memory=_memory())
+    assert CitationsContextChatEngine.from_shared(retriever, llm) is engine
+    # options cannot be applied to the existing engine
+    with pytest.raises(ValueError):
+        CitationsContextChatEngine.from_shared(retriever, llm, memory=_memory())
+    other = CitationsContextChatEngine.from_shared(_Retriever(), llm, memory=_memory())
+    assert other is not engine
+
+    first, second = _memory(), _memory()
+    engine.chat_with("hi", first)
+    asyncio.run(engine.achat_with("hello", second))
+    response = engine.stream_chat_with("again", first)
+    assert "".join(response.response_gen) == "text "
+
+    assert [m.content for m in first.get_all()] == ["hi", "text", "again", "text"]
+    assert [m.content for m in second.get_all()] == ["hello", "text"]
+    assert engine.chat_history == []
+
+
+def test_get_stream_pool_size(monkeypatch):
+    monkeypatch.delenv("LLAMA_CHAT_POOL", raising=False)
+    assert _get_stream_pool_size() == DEFAULT_STREAM_POOL_SIZE
+    monkeypatch.setenv("LLAMA_CHAT_POOL", "8")
+    assert _get_stream_pool_size() == 8
+    for value in ["eight", "", "0", "-1"]:
+        monkeypatch.setenv("LLAMA_CHAT_POOL", value)
+        assert _get_stream_pool_size() == DEFAULT_STREAM_POOL_SIZE
+
+
+def test_stream_writer_gets_own_thread_when_pool_is_full(monkeypatch):
+    thread_names = []
+    done = threading.Event()
+
+    def write_response(name: str) -> None:
+        thread_names.append((name, threading.current_thread().name))
+        done.set()
+
+    _start_stream_writer(write_response, "pooled")
+    assert done.wait(5)
+    assert thread_names[-1][1].startswith("citations_chat_stream")
+
+    # every pool worker is busy
+    done.clear()
+    monkeypatch.setattr(
+        citations_context_chat_engine, "_stream_pool_slots", threading.Semaphore(0)
+    )
+    _start_stream_writer(write_response, "overflow")
+    assert done.wait(5)
+    assert not thread_names[-1][1].startswith("citations_chat_stream")
+
+
+def test_achat_converts_documents_while_rendering_context(monkeypatch):
+    engine = CitationsContextChatEngine.from_defaults(
+        _Retriever(), llm=MockLLM(max_tokens=1), memory=_memory()
+    )
+    conversion_started = threading.Event()
+    convert = citations_context_chat_engine.convert_nodes_to_documents_list_cached
+
+    def convert_nodes_to_documents_list_cached(nodes):
+        conversion_started.set()
+        return convert(nodes)
+
+    get_context_str = engine._get_context_str
+    overlapped = []
+
+    def render_context_str(nodes):
+        overlapped.append(conversion_started.wait(5))
+        return get_context_str(nodes)
+
+    monkeypatch.setattr(
+        citations_context_chat_engine,
+        "convert_nodes_to_documents_list_cached",
+        convert_nodes_to_documents_list_cached,
+    )
+    monkeypatch.setattr(engine, "_get_context_str", render_context_str)
+
+    response = asyncio.run(engine.achat("a message converted while rendering"))
+    assert overlapped == [True]
+    assert response.source_nodes[0].node.text == "a message converted while rendering"
+
+
+def test_speculative_achat_counts_kv_access_for_used_request():
+    for refined_ids, frequencies in [
+        (["a", "b"], {"a": 2, "b": 2, "c": 1}),
+        (["b", "c"], {"a": 1, "b": 2, "c": 2}),
+    ]:
+        kv_cache = CohereDocKVCache()
+        for doc_id in ["a", "b", "c"]:
+            kv_cache.put(doc_id, b"kv")
+        engine, llm = _speculative_engine(refined_ids, kv_cache=kv_cache)
+        asyncio.run(engine.achat("hi"))
+        assert {
+            doc_id: entry.frequency for doc_id, entry in kv_cache._entries.items()
+        } == frequencies
+
+
+def test_speculative_achat_awaits_discarded_request():
+    engine, llm = _speculative_engine(["b", "c"])
+    llm._fail_on_cancel = True
+    loop_errors = []
+
+    async def achat() -> Any:
+        asyncio.get_running_loop().set_exception_handler(
+            lambda loop, context: loop_errors.append(context)
+        )
+        response = await engine.achat("hi")
+        gc.collect()
+        await asyncio.sleep(0)
+        return response
+
+    response = asyncio.run(achat())
+    assert llm._requests == [["a", "b"], ["b", "c"]]
+    assert [n.node.node_id for n in response.source_nodes] == ["b", "c"]
+    assert loop_errors == []
+
+
+def test_speculative_rejects_context_cache():
+    with pytest.raises(ValueError):
+        _speculative_engine(["a", "b"], context_cache=SemanticContextCache())
+
+
+def test_to_user_message():
+    message = _to_user_message("".join(["ye", "s"]))
+    assert message.role == MessageRole.USER
+    assert message.content is _to_user_message("yes").content
+
+    # str subclasses are kept as they are
+    message = _to_user_message(np.str_("yes"))
+    assert message.content == "yes"